@@ -1,7 +1,8 @@
-from collections import OrderedDict
 import xml.etree.ElementTree as ET
 from Preprocessor import *
-import collections
+from TermPostings import *
+from pyroaring import FrozenBitMap
+import numpy as np
 import os
 
 class InvertedIndex(object):
@@ -11,7 +12,11 @@ class InvertedIndex(object):
     Fields
     ------
     invertedIndexDictionary : Object of type InvertedIndex()
-        The positional inverted index data structure
+        The positional inverted index data structure - {term, {docID, positions}}, where each term's dictionary becomes a TermPostings object once the index is compacted
+    termDocumentBitMaps : Dictionary type
+        Stores for each compacted term the immutable Roaring bitmap of the document IDs in which it occurs - built lazily on first use
+    termDocumentArrays : Dictionary type
+        Stores for each term a pair of contiguous arrays (document IDs, term frequencies) sorted by document ID - built by "compactIndex" or "importPostingArrays"
     ppr : Object of type Preprocessor
         The preprocessing toolkit
     """
@@ -21,6 +26,8 @@ class InvertedIndex(object):
         """Constructor of Class InvertedIndex initializes inverted index dictionary structure
         """
         self.invertedIndexDictionary = {}
+        self.termDocumentBitMaps = {} # Dictionary of frozen Roaring bitmaps - {term, docIDs} - cached so boolean queries don't rebuild sets
+        self.termDocumentArrays = {} # Dictionary of (docIDs, term frequencies) int32 array pairs - {term, (docIDs, tfs)}
 
     def buildIndexFromFile(self, pathToFile):
         """Invokes parsing method in order to build the positional inverted index from a given collection (file)
@@ -29,8 +36,13 @@ class InvertedIndex(object):
         ----------
         pathToFile : String type
             The path leading to the collection file
+
+        Notes
+        -----
+        The index is compacted once the collection is parsed (see "compactIndex"), so no occurrences can be inserted afterwards
         """
         self.parseXMLFile(pathToFile)
+        self.compactIndex()
 
     def initializeTerm(self, term):
         """Initializes the dictionary structure for the documents in which the term is located
@@ -40,7 +52,7 @@ class InvertedIndex(object):
         term : String type
             A given term
         """
-        self.invertedIndexDictionary[term] = OrderedDict()
+        self.invertedIndexDictionary[term] = {}
 
     def initializeDoc(self, term , docID):
         """Initializes the list of positions that the term occurs within a document
@@ -100,14 +112,19 @@ class InvertedIndex(object):
 
         Returns
         -------
-        documentSet : Set type
-            A set containing the documents that contain the given term
+        documentSet : FrozenBitMap type
+            An immutable Roaring bitmap containing the documents that contain the given term - shared with the index, so it can be returned as a query result without copying
         """
-        if term not in self.invertedIndexDictionary:
-            emptySet = ()
-            return emptySet
+        if term in self.termDocumentBitMaps:
+            return self.termDocumentBitMaps[term]
+        elif term in self.termDocumentArrays: # Compacted terms get their bitmap on first use
+            self.termDocumentBitMaps[term] = FrozenBitMap(self.termDocumentArrays[term][0].tolist())
+            return self.termDocumentBitMaps[term]
+        elif term in self.invertedIndexDictionary: # Not compacted yet - the documents may still change, so nothing is cached
+            return FrozenBitMap(self.invertedIndexDictionary[term].keys())
         else:
-            return set(self.invertedIndexDictionary[term].keys())
+            emptySet = FrozenBitMap()
+            return emptySet
 
     def getTermDocumentDictionary(self, term):
         """Returns the dictionary of document IDs and list of positions for a given term
@@ -119,8 +136,8 @@ class InvertedIndex(object):
 
         Returns
         -------
-        termDictionary : Dictionary type
-            A dictionary containing the documents that contain the given term and the list of positions for each document in which the term appears
+        termDictionary : Dictionary or TermPostings type
+            A dictionary containing the documents that contain the given term and the list of positions for each document in which the term appears - a TermPostings object once the index is compacted
         """
         if term not in self.invertedIndexDictionary:
             emptyDictionary = {}
@@ -128,6 +145,47 @@ class InvertedIndex(object):
         else:
             return self.invertedIndexDictionary[term]
 
+    def compactIndex(self):
+        """Converts the posting dictionary of every term into a TermPostings object (contiguous docID, offset and position arrays)
+        and builds the arrays of document IDs and term frequencies used for vectorized scoring
+
+        Notes
+        -----
+        TermPostings objects are read-only, so no occurrences can be inserted for a term once the index has been compacted
+        """
+        self.termDocumentArrays = {}
+        self.termDocumentBitMaps = {} # Rebuilt from the new arrays on first use
+        for term, documentDictionary in self.invertedIndexDictionary.items():
+            if not isinstance(documentDictionary, TermPostings):
+                documentDictionary = TermPostings.fromDictionary(documentDictionary)
+                self.invertedIndexDictionary[term] = documentDictionary
+            self.termDocumentArrays[term] = (documentDictionary.docIDs, documentDictionary.getTermFrequencies())
+
+    def getTermDocumentArrays(self, term):
+        """Returns the arrays of document IDs and term frequencies for a given term
+
+        Parameters
+        ----------
+        term : String type
+            A given term whose document IDs and frequencies need to be retrieved
+
+        Returns
+        -------
+        termDocumentArrays : Tuple type of two int32 numpy arrays
+            The sorted IDs of the documents that contain the given term and the number of occurrences of the term in each of them
+
+        Notes
+        -----
+        Raises ValueError for a term whose occurrences were inserted after the index was last compacted - its arrays would silently be empty
+        """
+        if term in self.termDocumentArrays:
+            return self.termDocumentArrays[term]
+        elif term in self.invertedIndexDictionary:
+            raise ValueError('Term "{}" is not compacted - call compactIndex after inserting occurrences'.format(term))
+        else:
+            emptyArray = np.zeros(0, dtype=np.int32)
+            return (emptyArray, emptyArray)
+
     def getIndexDictionary(self):
         """Returns the inverted index dictionary
 
@@ -164,10 +222,9 @@ class InvertedIndex(object):
                         headlineAndText = headlineText + ' ' + text
                     else:
                         headlineAndText = text
-                    for word in self.ppr.tokenize(self.ppr.toLowerCase(headlineAndText)):
-                        if (len(word) > 0) and (self.ppr.isNotAStopword(word)):
-                            self.insertTermOccurrence(self.ppr.stemWordPorter(word), docID, position)
-                            position += 1
+                    for term in self.ppr.extractTerms(headlineAndText):
+                        self.insertTermOccurrence(term, docID, position)
+                        position += 1
 
     def exportInvertedIndexToDirectory(self, pathToFile):
         """Exports the positional inverted index to a file within a specified directory
@@ -191,6 +248,145 @@ class InvertedIndex(object):
                     output.write('\t{}: {}\n'.format(doc, positionList))
                 output.write('\n')
 
+    def exportPackedIndex(self, pathToFile):
+        """Exports the positional inverted index to a binary numpy archive (.npz) that can be loaded without any text parsing
+
+        Parameters
+        ----------
+        pathToFile : String type
+            Path leading to the output file
+
+        Notes
+        -----
+        Postings are flattened into contiguous arrays - the documents of term i are docIDs[termOffsets[i]:termOffsets[i+1]]
+        and the positions of document j are positions[positionOffsets[j]:positionOffsets[j+1]].
+        The archive stores the terms as a single newline separated UTF-8 string, and the term frequencies instead of "positionOffsets"
+        """
+        terms = list(self.invertedIndexDictionary.keys())
+        listOfPostings = [self.invertedIndexDictionary[term] if isinstance(self.invertedIndexDictionary[term], TermPostings) else TermPostings.fromDictionary(self.invertedIndexDictionary[term]) for term in terms]
+        termOffsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        termOffsets[1:] = np.cumsum([len(termPostings) for termPostings in listOfPostings])
+        docIDs = np.concatenate([np.zeros(0, dtype=np.int32)] + [termPostings.docIDs for termPostings in listOfPostings])
+        positionOffsets = np.zeros(len(docIDs) + 1, dtype=np.int64)
+        positionOffsets[1:] = np.cumsum(np.concatenate([np.zeros(0, dtype=np.int64)] + [np.diff(termPostings.offsets) for termPostings in listOfPostings]))
+        positions = np.concatenate([np.zeros(0, dtype=np.int32)] + [termPostings.getAllPositions() for termPostings in listOfPostings])
+        self.writePackedIndex(pathToFile, terms, termOffsets, docIDs, positionOffsets, positions)
+
+    def writePackedIndex(self, pathToFile, terms, termOffsets, docIDs, positionOffsets, positions, sourceFileStamp=None):
+        """Writes already flattened postings to a binary numpy archive (.npz) - see "exportPackedIndex" for the layout
+
+        Parameters
+        ----------
+        pathToFile : String type
+            Path leading to the output file
+        terms : List of strings
+            The terms of the index
+        termOffsets : Numpy array type of int64
+            The offsets of each term's documents within "docIDs"
+        docIDs : Numpy array type of int32
+            The document IDs of all terms
+        positionOffsets : Numpy array type of int64
+            The offsets of each document's positions within "positions"
+        positions : Numpy array type of int32
+            The positions of all documents of all terms
+        sourceFileStamp : Numpy array type of int64
+            Optional (size, modification time in ns) of the text index the postings were parsed from - see "importPackedIndex"
+
+        Notes
+        -----
+        The archive is written to a temporary file first and then moved into place, so an interrupted write never leaves a truncated archive behind
+        """
+        joinedTerms = np.frombuffer('\n'.join(terms).encode('utf-8'), dtype=np.uint8) # One UTF-8 string instead of an array padding every term to the longest one
+        termFrequencies = np.diff(positionOffsets).astype(np.int32) # Half the size of the offsets - rebuilt with a cumulative sum on import
+        packedArrays = {'joinedTerms': joinedTerms, 'termOffsets': termOffsets, 'docIDs': docIDs, 'termFrequencies': termFrequencies, 'positions': positions}
+        if sourceFileStamp is not None:
+            packedArrays['sourceFileStamp'] = sourceFileStamp
+        temporaryPathToFile = pathToFile + '.tmp'
+        try:
+            with open(temporaryPathToFile, 'wb') as output: # Passing a file object stops numpy from appending another ".npz"
+                np.savez(output, **packedArrays)
+            os.replace(temporaryPathToFile, pathToFile)
+        except OSError:
+            if os.path.isfile(temporaryPathToFile):
+                os.remove(temporaryPathToFile)
+            raise
+
+    def importPackedIndex(self, pathToFile, sourceFileStamp=None):
+        """Imports a positional inverted index previously exported with "exportPackedIndex"
+
+        Parameters
+        ----------
+        pathToFile : String type
+            Path leading to the binary index file
+        sourceFileStamp : Numpy array type of int64
+            Optional (size, modification time in ns) of the text index - the archive is only imported if it was written with exactly this stamp
+
+        Returns
+        -------
+        isImported : Boolean type
+            False if the archive was built from a different text index, in which case nothing is imported
+
+        Notes
+        -----
+        Raises OSError, ValueError, KeyError, EOFError or zipfile.BadZipFile if the file is missing, truncated or not a packed index
+        """
+        with np.load(pathToFile) as packedIndex:
+            if sourceFileStamp is not None and ('sourceFileStamp' not in packedIndex.files or not np.array_equal(packedIndex['sourceFileStamp'], sourceFileStamp)):
+                return False # Stale archive - the postings are not even read
+            joinedTerms = packedIndex['joinedTerms'].tobytes().decode('utf-8')
+            terms = joinedTerms.split('\n') if len(joinedTerms) > 0 else [] # Terms never contain whitespace
+            termOffsets = packedIndex['termOffsets']
+            docIDs = packedIndex['docIDs']
+            termFrequencies = packedIndex['termFrequencies']
+            positions = packedIndex['positions']
+        positionOffsets = np.zeros(len(termFrequencies) + 1, dtype=np.int64)
+        positionOffsets[1:] = np.cumsum(termFrequencies)
+        if (len(termOffsets) != len(terms) + 1 or termOffsets[0] != 0 or termOffsets[-1] != len(docIDs) or np.any(np.diff(termOffsets) < 0)
+                or len(positionOffsets) != len(docIDs) + 1 or positionOffsets[0] != 0 or positionOffsets[-1] != len(positions) or np.any(np.diff(positionOffsets) < 0)):
+            raise ValueError('Malformed packed index file: {}'.format(pathToFile)) # Checked before anything is imported, so a bad file leaves the index untouched
+        self.importPostingArrays(terms, termOffsets, docIDs, positionOffsets, positions)
+        return True
+
+    def importPostingArrays(self, terms, termOffsets, docIDs, positionOffsets, positions):
+        """Imports flattened postings (layout of "exportPackedIndex") as TermPostings views, without per term numpy work
+
+        Parameters
+        ----------
+        terms : List of strings
+            The terms of the index
+        termOffsets : Numpy array type of int64
+            The offsets of each term's documents within "docIDs"
+        docIDs : Numpy array type of int32
+            The document IDs of all terms
+        positionOffsets : Numpy array type of int64
+            The offsets of each document's positions within "positions"
+        positions : Numpy array type of int32
+            The positions of all documents of all terms
+
+        Notes
+        -----
+        The imported index is already compact, see "compactIndex"
+        """
+        documentFrequencies = np.diff(termOffsets)
+        isUnsorted = np.diff(docIDs) <= 0
+        isUnsorted[termOffsets[1:-1] - 1] = False # A new term starts there
+        if isUnsorted.any(): # Sort every term's documents in one go and move their position runs along
+            termIndices = np.repeat(np.arange(len(terms)), documentFrequencies)
+            order = np.lexsort((docIDs, termIndices))
+            termFrequencies = np.diff(positionOffsets)[order]
+            sortedPositionOffsets = np.zeros(len(docIDs) + 1, dtype=np.int64)
+            sortedPositionOffsets[1:] = np.cumsum(termFrequencies)
+            positions = positions[np.repeat(positionOffsets[:-1][order] - sortedPositionOffsets[:-1], termFrequencies) + np.arange(sortedPositionOffsets[-1])]
+            docIDs = docIDs[order]
+            positionOffsets = sortedPositionOffsets
+        termFrequencies = np.diff(positionOffsets).astype(np.int32)
+        listOfTermOffsets = termOffsets.tolist()
+        for i, term in enumerate(terms):
+            start, end = listOfTermOffsets[i], listOfTermOffsets[i + 1]
+            termDocIDs = docIDs[start:end]
+            self.invertedIndexDictionary[term] = TermPostings(termDocIDs, positionOffsets[start:end + 1], positions) # Views into the flat arrays - no copies
+            self.termDocumentArrays[term] = (termDocIDs, termFrequencies[start:end])
+
     def orderIndex(self, invertedIndex):
         """Sorts the inverted index based on its keys - used when writing the index to a file in key order (alphanumeric)
 
@@ -204,7 +400,7 @@ class InvertedIndex(object):
         sortedII : InvertedIndex object type
             The key sorted version of the inverted index
         """
-        return collections.OrderedDict(sorted(invertedIndex.items()))
+        return dict(sorted(invertedIndex.items())) # Dictionaries preserve insertion order
 
     def printLength(self):
         '''Method that prints the number of items in the index
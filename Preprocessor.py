@@ -2,6 +2,8 @@ from nltk.stem import PorterStemmer # Porter Stemmer
 import re # Python regular expressions
 # from nltk.stem.snowball import SnowballStemmerpo
 
+tokenizerRegex = re.compile(r'(?!\&\b)\W+') # Compiled once - tokenize is invoked for every document and query
+
 class Preprocessor(object):
     """Class of type object that provides a basic toolkit for text preprocessing
 
@@ -11,6 +13,8 @@ class Preprocessor(object):
         The set with all stopwords
     porter: Object of type PorterStemmer
         The porter stemmer utility
+    stemmedWordsDictionary : Dictionary type
+        Cache of already stemmed words - {word, stemmedWord}
     """
     stopwords = set() # Set with stopwords - O(1) search
     porter = PorterStemmer()
@@ -19,9 +23,10 @@ class Preprocessor(object):
         """Constructor of Class Preprocessor
         """
         self.loadStopwords()
+        self.stemmedWordsDictionary = {} # Porter stemming is expensive and vocabularies are small, so each word is stemmed once
 
     def tokenize(self, string):
-        """Splits parameter 'string' and returns a list of the tokens.
+        r"""Splits parameter 'string' and returns a list of the tokens.
         The regular expression used is (?!\&\b)\W+ which splits the string in every non alphanumeric character (\W+).
         An exception to this is when a "&" is within a word (?!\&\b) e.g. AT&T, P&G, etc.
         These kinds of words should not be split.
@@ -36,7 +41,24 @@ class Preprocessor(object):
         tokens : List of strings
             A list containing all tokens
         """
-        return re.split(r'(?!\&\b)\W+', string) # r stands for raw expression
+        return tokenizerRegex.split(string)
+
+    def extractTerms(self, string):
+        """Lowercases and tokenizes the given string, drops empty tokens and stopwords, and stems the remaining ones
+
+        Parameters
+        ----------
+        string : String type
+            A text - e.g. a document or a query
+
+        Returns
+        -------
+        terms : List of strings
+            The stemmed terms of the text, in order of occurrence
+        """
+        stopwords = self.stopwords # Local lookups inside the comprehension
+        stemWordPorter = self.stemWordPorter
+        return [stemWordPorter(word) for word in self.tokenize(self.toLowerCase(string)) if len(word) > 0 and word not in stopwords]
 
     def stemWordPorter(self, word):
         """Stems the given word using the Porter Stemmer library
@@ -51,7 +73,11 @@ class Preprocessor(object):
         stemmedWord : String type
             The stemmed version of the given word
         """
-        return self.porter.stem(word)
+        stemmedWord = self.stemmedWordsDictionary.get(word)
+        if stemmedWord is None:
+            stemmedWord = self.porter.stem(word)
+            self.stemmedWordsDictionary[word] = stemmedWord
+        return stemmedWord
 
     def stemWordSnowball(self, word):
         """Stems the given word using the Snowball Stemmer library
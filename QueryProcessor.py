@@ -1,9 +1,133 @@
-from collections import OrderedDict
 from Preprocessor import *
 from InvertedIndex import *
+from pyroaring import BitMap, FrozenBitMap
+from collections import Counter
 import numpy as np
-import collections
-import operator
+from itertools import islice
+from operator import itemgetter
+import multiprocessing
+import re
+import zipfile
+try:
+    from numba import njit
+except ImportError: # Numba is optional - proximity queries then use NumPy broadcasting and the pure Python linear merge
+    njit = None
+
+nonDigitsRegex = re.compile(r'[^0-9]+') # Used to extract the distance of proximity queries
+booleanResultRow = '{:<3}{:<3}{:<8}{:<3}{:<8}{:<3}\n'.format # Bound format methods reused for every output row
+rankedResultRow = '{:<3}{:<3}{:<8}{:<3}{:<8.3f}{:<3}\n'.format
+
+def emptyResultRow(queryID):
+    """Formats the row written for a query without results, in either output file
+
+    Parameters
+    ----------
+    queryID : Int or String type
+        The ID of the query
+
+    Returns
+    -------
+    row : String type
+        The "null" result row, using the boolean column widths
+    """
+    return booleanResultRow(queryID, 0, 'null', 0, 'null', 0)
+
+def linearMergeMatch(positions1, positions2, distance, isPhrase):
+    """Linear merge of two sorted position lists - determines whether any pair of positions lies within the given distance
+
+    Parameters
+    ----------
+    positions1 : Numpy array type of int32
+        The sorted positions of the first term in a document
+    positions2 : Numpy array type of int32
+        The sorted positions of the second term in the same document
+    distance : Int type
+        The maximum distance between the two terms
+    isPhrase : Boolean type
+        When True the second term has to occur after the first one
+
+    Returns
+    -------
+    isMatch : Boolean type
+        True if the two terms occur within the wanted distance, otherwise False
+    """
+    i = 0 # Index i for linear merge implementation
+    j = 0 # Index j for linear merge implementation
+    while True: # Linear merge comparison - first occurrence satisfies since boolean search only returns docIDs, not positions
+        difference = positions1[i] - positions2[j]
+        if abs(difference) <= distance and (difference <= 0 or not isPhrase): # In case it is a phrase order matters, so the second term should appear only after the first one
+            return True
+        if positions1[i] < positions2[j] and i < len(positions1) - 1:
+            i += 1
+        elif positions1[i] >= positions2[j] and j < len(positions2) - 1:
+            j += 1
+        else:
+            return False # Only if both indeces have exceeded the structure then break
+
+if njit is not None:
+    linearMergeMatchCompiled = njit(cache=True)(linearMergeMatch) # Native version of the linear merge - same semantics, no interpreter overhead per step
+    linearMergeMatchCompiled(np.zeros(1, dtype=np.int32), np.zeros(1, dtype=np.int32), 1, True) # Warm up - compile once at import rather than in the first query
+else:
+    linearMergeMatchCompiled = None
+
+def skewedIntersection(smallerArray, largerArray):
+    """Intersects two sorted arrays of unique document IDs by binary searching every element of the smaller one in the larger one.
+    Costs O(m log n) instead of the O(m + n) of a merge, which pays off when the larger array is much longer
+
+    Parameters
+    ----------
+    smallerArray : Numpy array type of int32
+        The shorter sorted docID array
+    largerArray : Numpy array type of int32
+        The longer sorted docID array
+
+    Returns
+    -------
+    indices : Tuple type of two numpy arrays
+        The indices of the common docIDs within the smaller and within the larger array, in ascending docID order
+    """
+    if len(largerArray) == 0:
+        return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+    largerIndices = np.minimum(np.searchsorted(largerArray, smallerArray), len(largerArray) - 1) # Vectorized search - no Python loop per document
+    isCommon = largerArray[largerIndices] == smallerArray
+    return (np.flatnonzero(isCommon), largerIndices[isCommon])
+
+def splitNegation(expression):
+    """Separates a leading "NOT" operator from the term or phrase it negates
+
+    Parameters
+    ----------
+    expression : String type
+        A singular expression - e.g. "NOT crime", "Scotland", etc.
+
+    Returns
+    -------
+    negation : Tuple type of (Boolean, String)
+        Whether the expression is negated, and the term or phrase without the operator - "NOTHING" is a term, not a negation
+    """
+    expression = expression.strip()
+    if expression.startswith('NOT '):
+        return (True, expression[4:].strip())
+    return (False, expression)
+
+sharedQueryProcessor = None # Set while worker processes are forked - they inherit the loaded index instead of receiving a pickled copy
+
+def runSharedQuery(handlerName, query):
+    """Runs a query handler of the shared query processor - executed inside forked worker processes
+
+    Parameters
+    ----------
+    handlerName : String type
+        The name of the QueryProcessor method handling the query - e.g. "complexExpressionHandler"
+    query : String type
+        The query to be executed
+
+    Returns
+    -------
+    result : Object type
+        The result of the query handler
+    """
+    return getattr(sharedQueryProcessor, handlerName)(query)
 
 class QueryProcessor(object):
     """Class of type object implementing a query processor engine
@@ -12,13 +136,27 @@ class QueryProcessor(object):
     ------
     ii : Object of type InvertedIndex()
         The positional inverted index data structure
-    docIDSet: Set type
-        Contains all document IDs
+    docIDSet: FrozenBitMap type
+        Immutable Roaring bitmap containing all document IDs
     collectionSize : Int type
         Stores the collection size
-    booleanQueriesDictionary : Ordered Dictionary data structure
+    maxDocID : Int type
+        Stores the largest document ID - used to size the TF-IDF score arrays
+    numberOfRankedResults : Int type
+        The number of best scoring documents kept for each TF-IDF query
+    proximityBroadcastLimit : Int type
+        Largest number of position pairs compared at once with NumPy broadcasting in proximity queries - longer lists fall back to linear merge
+    skewedIntersectionRatio : Int type
+        Document frequency ratio above which posting lists are intersected by binary searching the smaller one in the larger one instead of merging
+    termIDFDictionary : Dictionary type
+        Stores the precomputed inverse document frequency of every term in the index
+    termLogTFDictionary : Dictionary type
+        Stores for every term the precomputed array of (1 + log10(tf)) weights, aligned with the term's document ID array
+    termUpperBoundDictionary : Dictionary type
+        Stores for every term the highest TFIDF score it can contribute to a document - used to skip documents that cannot enter the top results
+    booleanQueriesDictionary : Dictionary data structure
         Stores all boolean queries imported from file in a (key, value) pair, where: key = query ID and value = query string
-    tfidfQueriesDictionary : Ordered Dictionary data structure
+    tfidfQueriesDictionary : Dictionary data structure
         Stores all tfidf ranked queries imported from file in a (key, value) pair, where: key = query ID and value = query string
     ppr : Object of type Preprocessor
         The preprocessing toolkit
@@ -28,29 +166,72 @@ class QueryProcessor(object):
         """Constructor of QueryProcessor object
         """
         self.ii = InvertedIndex()
-        self.docIDSet = set()  # Set used to calculate complementary sets ("NOT" case) and collection size (TF-IDF)
+        self.docIDSet = FrozenBitMap()  # Bitmap used to calculate complementary sets ("NOT" case) and collection size (TF-IDF)
         self.collectionSize = 0 # Variable used to store the collection size for calculating the TFIDF queries
-        self.booleanQueriesDictionary = OrderedDict() # Ordered dictionary used to store boolean queries - {queryID, booleanQuery}
-        self.tfidfQueriesDictionary = OrderedDict() # Ordered dictionary used to store tfidf queries - {queryID, tfidfQuery}
-        self.queryTopRelevantDocumentsDictionary = OrderedDict() # Ordered dictionary to store top k query results
+        self.maxDocID = 0 # Variable used to store the largest document ID for sizing the TFIDF score arrays
+        self.numberOfRankedResults = 1000 # Number of top documents kept for each TFIDF query
+        self.proximityBroadcastLimit = 1000000 # Bounds the memory of the |p1 - p2| matrix built per document in proximity queries
+        self.skewedIntersectionRatio = 32 # Beyond this df ratio a merge mostly walks the larger posting list for nothing
+        self.termIDFDictionary = {} # Dictionary of query independent idf values - {term, idf}
+        self.termLogTFDictionary = {} # Dictionary of query independent tf weight arrays - {term, 1 + log10(tf)}
+        self.termUpperBoundDictionary = {} # Dictionary of maximum term score contributions - {term, max(1 + log10(tf)) * idf}
+        self.booleanQueriesDictionary = {} # Dictionary used to store boolean queries - {queryID, booleanQuery}
+        self.tfidfQueriesDictionary = {} # Dictionary used to store tfidf queries - {queryID, tfidfQuery}
+        self.queryTopRelevantDocumentsDictionary = {} # Dictionary to store top k query results
         self.miniIndex = InvertedIndex() # Mini Inverted index used for the PRF TF-IDF score calculation
         self.termTFIDFDictionary = {} # Dictionary to store terms and their tfidf for the PRF module
 
-    def executeBooleanQueries(self):
+    def executeBooleanQueries(self, numberOfProcesses=1):
         """Initializes results variable and invokes necessary methods to execute each of the given boolean queries
 
+        Parameters
+        ----------
+        numberOfProcesses : Int type
+            The number of processes the queries are distributed to - e.g. os.cpu_count() to use every core
+
         Notes
         -----
         Does not return results. Instead, invokes the "writeBooleanResultsToFile" method, which exports them to a file
         """
-        queryResults = OrderedDict()
-        for k, v in self.booleanQueriesDictionary.items():
-            queryResults[k] = self.complexExpressionHandler(v)
+        queryResults = self.executeQueries('complexExpressionHandler', self.booleanQueriesDictionary, numberOfProcesses)
         self.writeBooleanResultsToFile(queryResults, 'out/results.boolean.txt')
 
+    def executeQueries(self, handlerName, queriesDictionary, numberOfProcesses):
+        """Executes every query with the given handler, in parallel when more than one process is requested.
+        Queries only read the index, so workers are forked after it has been imported and share it copy-on-write
+
+        Parameters
+        ----------
+        handlerName : String type
+            The name of the method handling each query - e.g. "complexExpressionHandler" or "calculateTFIDF"
+        queriesDictionary : Dictionary type
+            The queries in (key, value) pairs, where key = query ID and value = query string
+        numberOfProcesses : Int type
+            The number of worker processes - falls back to sequential execution when it is 1 or forking is not supported (e.g. Windows)
+
+        Returns
+        -------
+        queryResults : Dictionary type
+            Dictionary containing (key, value) pairs, where key = query ID and value = corresponding results
+        """
+        global sharedQueryProcessor
+        queries = list(queriesDictionary.values())
+        if numberOfProcesses > 1 and len(queries) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            sharedQueryProcessor = self
+            try:
+                with multiprocessing.get_context('fork').Pool(min(numberOfProcesses, len(queries))) as pool:
+                    results = pool.starmap(runSharedQuery, [(handlerName, query) for query in queries])
+            finally:
+                sharedQueryProcessor = None
+        else:
+            handler = getattr(self, handlerName)
+            results = [handler(query) for query in queries]
+        return dict(zip(queriesDictionary.keys(), results))
+
     def complexExpressionHandler(self, query):
         """Parses and handles a logical expression.
-        Afterwards, passes necessary arguments to method "simpleExpressionHandler" to retrieve subsets
+        Afterwards, passes necessary arguments to method "simpleExpressionHandler" to retrieve subsets.
+        Expressions may chain any number of operands with the same operator - e.g. "a AND b AND c"
 
         Parameters
         ----------
@@ -59,21 +240,33 @@ class QueryProcessor(object):
 
         Returns
         -------
-        documents : Set type
-            A set containing the documents fulfilling the search criteria
+        documents : BitMap type
+            A bitmap containing the documents fulfilling the search criteria
         """
-        expressionSets = [] # List of sets used for AND & OR expressions handling
-        if " AND " in query:
-            for simpleExpression in query.split(' AND '):
-                expressionSets.append(self.simpleExpressionHandler(simpleExpression.strip()))
-            return expressionSets[0].intersection(expressionSets[1])
-        elif " OR " in query:
-            for simpleExpression in query.split(' OR '):
-                expressionSets.append(self.simpleExpressionHandler(simpleExpression.strip()))
-            return expressionSets[0].union(expressionSets[1])
+        conjunctions = query.split(' AND ')
+        disjunctions = query.split(' OR ') if len(conjunctions) == 1 else []
+        if len(conjunctions) > 1: # Any number of operands - e.g. "a AND b AND NOT c"
+            expressionSets = [] # Sets of the plain operands
+            negatedExpressionSets = [] # Sets of the "NOT" operands - subtracted instead of intersecting with their complement
+            for simpleExpression in conjunctions:
+                isNegated, termExpression = splitNegation(simpleExpression)
+                if isNegated:
+                    negatedExpressionSets.append(self.termExpressionHandler(termExpression))
+                else:
+                    expressionSets.append(self.termExpressionHandler(termExpression))
+            if len(expressionSets) > 0:
+                documents = BitMap.intersection(*sorted(expressionSets, key=len)) # Multi-way bitmap intersection - smallest sets first keep intermediate results small
+            else:
+                documents = self.docIDSet
+            if len(negatedExpressionSets) > 0:
+                documents = documents - BitMap.union(*negatedExpressionSets) # "a AND NOT b" as a single ANDNOT - the complement of b is never built
+            return documents
+        elif len(disjunctions) > 1:
+            expressionSets = [self.simpleExpressionHandler(simpleExpression.strip()) for simpleExpression in disjunctions]
+            return BitMap.union(*expressionSets) # Multi-way bitmap union
         elif "#" in query:
             tempList = query.split('(')
-            distance = int(re.sub('[^0-9]+', '', tempList[0])) # Extract distance
+            distance = int(nonDigitsRegex.sub('', tempList[0])) # Extract distance
             termPair = tempList[1].split(')')[0] # Exract term pair
             return self.proximityHandler(termPair, distance, False) # Send to proximity handler and return result
         else:
@@ -89,20 +282,32 @@ class QueryProcessor(object):
 
         Returns
         -------
-        documents : Set type
-            A set containing the documents matching the singular expression
+        documents : BitMap type
+            A bitmap containing the documents matching the singular expression
         """
-        if 'NOT' in singleExpression:
-            standaloneTerm = singleExpression.split('NOT', 1)[1].strip()
-            if '"' in standaloneTerm:
-                termDocumentSet = self.phraseHandler(standaloneTerm)
-            else:
-                termDocumentSet = self.ii.getTermDocumentSet(self.preprocessedTerm(standaloneTerm))
-            return self.docIDSet - termDocumentSet # Return complementary
-        elif '"' in singleExpression:
-            return self.phraseHandler(singleExpression) # Convert to proximity with distance = 1 and specify that term occurrence order matters - isPhrase = True
+        isNegated, termExpression = splitNegation(singleExpression)
+        if isNegated:
+            return self.docIDSet - self.termExpressionHandler(termExpression) # Return complementary - bitmap ANDNOT against the whole collection
         else:
-            return self.ii.getTermDocumentSet(self.preprocessedTerm(singleExpression))
+            return self.termExpressionHandler(termExpression)
+
+    def termExpressionHandler(self, termExpression):
+        """Determines the set corresponding to a term or a phrase, without negation
+
+        Parameters
+        ----------
+        termExpression : String type
+            A term or a phrase - e.g. "crime", "\"middle east\"", etc.
+
+        Returns
+        -------
+        documents : BitMap type
+            A bitmap containing the documents matching the term or phrase
+        """
+        if '"' in termExpression:
+            return self.phraseHandler(termExpression) # Convert to proximity with distance = 1 and specify that term occurrence order matters - isPhrase = True
+        else:
+            return self.ii.getTermDocumentSet(self.preprocessedTerm(termExpression))
 
     def phraseHandler(self, phraseQuery):
         '''Method that handles phrase queries'''
@@ -116,15 +321,15 @@ class QueryProcessor(object):
 
         Returns
         -------
-        documents : Set type
+        documents : BitMap type
             Returns the result of the proximity handler method, which are the documents containing the given phrase
         """
-        termsWithoutQuotes = re.sub(r'[\"]+', '', phraseQuery)
-        termsCommaSeparated = re.sub(r' ', ',', termsWithoutQuotes) # Convert to proximity format
+        termsWithoutQuotes = phraseQuery.replace('"', '')
+        termsCommaSeparated = termsWithoutQuotes.replace(' ', ',') # Convert to proximity format
         return self.proximityHandler(termsCommaSeparated, 1, True)
 
     def proximityHandler(self, proximityQuery, distance, isPhrase):
-        """Handles proximity queries - implements linear merge to compare the given terms' positions
+        """Handles proximity queries - compares the given terms' positions within every document containing both
 
         Parameters
         ----------
@@ -137,50 +342,76 @@ class QueryProcessor(object):
 
         Returns
         -------
-        documents : Set type
+        documents : BitMap type
             Returns the documents that contain the given terms within the wanted distance
         """
         termPair = proximityQuery.split(',')
         term1 = termPair[0].strip() # Extract term 1
         term2 = termPair[1].strip() # Extract term 2
-        dict1 = self.ii.getTermDocumentDictionary(self.preprocessedTerm(term1))
-        dict2 = self.ii.getTermDocumentDictionary(self.preprocessedTerm(term2))
-        intersection = sorted(set(dict1.keys()).intersection(set(dict2.keys()))) # Search only in their intersection - no point in searching the whole collection.
-        matchingDocuments = [] # List to store all matching documets
-        for document in intersection:
-            currentDocumentList1 = dict1[document]
-            currentDocumentList2 = dict2[document]
-            i = 0 # Index i for linear merge implementation
-            j = 0 # Index j for linear merge implementation
-            thereIsNoMatch = True # Flag to break the while loop - first occurrence satisfies since boolean search only returns docIDs, not positions
-            notOutOfBounds = True # Flag to break the while loop - indeces should not exceed the
-            while(thereIsNoMatch and notOutOfBounds): # Linear merge comparison
-                if isPhrase:
-                    condition = ((currentDocumentList1[i] - currentDocumentList2[j]) <= 0) # In case it is a phrase order matters, so the second term should appear only after the first one
-                else:
-                    condition = True
-                if (abs((currentDocumentList1[i] - currentDocumentList2[j])) <= distance) and condition:
-                    thereIsNoMatch = False
-                    matchingDocuments.append(document)
-                else:
-                    if currentDocumentList1[i] < currentDocumentList2[j] and i < len(currentDocumentList1) - 1:
-                        i += 1
-                    elif currentDocumentList1[i] >= currentDocumentList2[j] and j < len(currentDocumentList2) - 1:
-                        j += 1
-                    else:
-                        notOutOfBounds = False # Only if both indeces have exceeded the structure then break
-        return set(matchingDocuments)
+        term1 = self.preprocessedTerm(term1)
+        term2 = self.preprocessedTerm(term2)
+        postings1 = self.ii.getTermDocumentDictionary(term1) # TermPostings - positions are read by index, without docID lookups
+        postings2 = self.ii.getTermDocumentDictionary(term2)
+        docIDs1 = self.ii.getTermDocumentArrays(term1)[0]
+        docIDs2 = self.ii.getTermDocumentArrays(term2)[0]
+        if len(docIDs1) == 0 or len(docIDs2) == 0 or docIDs1[-1] < docIDs2[0] or docIDs2[-1] < docIDs1[0]: # Disjoint docID ranges - nothing to merge
+            return BitMap()
+        if len(docIDs1) * self.skewedIntersectionRatio < len(docIDs2): # Very different document frequencies - binary search the few documents of the smaller list in the larger one
+            indices1, indices2 = skewedIntersection(docIDs1, docIDs2)
+        elif len(docIDs2) * self.skewedIntersectionRatio < len(docIDs1):
+            indices2, indices1 = skewedIntersection(docIDs2, docIDs1)
+        else:
+            indices1, indices2 = np.intersect1d(docIDs1, docIDs2, assume_unique=True, return_indices=True)[1:] # Search only in their intersection - merge of the sorted docID arrays, no hashing
+        matchingIndices = [] # List to store the indices (within docIDs1) of all matching documents
+        for index1, index2 in zip(indices1.tolist(), indices2.tolist()):
+            if self.positionsWithinDistance(postings1.getPositionsAt(index1), postings2.getPositionsAt(index2), distance, isPhrase):
+                matchingIndices.append(index1)
+        return BitMap(docIDs1[matchingIndices])
+
+    def positionsWithinDistance(self, positions1, positions2, distance, isPhrase):
+        """Determines whether two terms occur within the given distance in a document.
+        Uses the compiled linear merge when Numba is available, otherwise compares all position pairs at once using a broadcasted difference matrix
 
-    def executeTFIDFQueries(self):
+        Parameters
+        ----------
+        positions1 : Numpy array type of int32
+            The positions of the first term in a document
+        positions2 : Numpy array type of int32
+            The positions of the second term in the same document
+        distance : Int type
+            The maximum distance between the two terms
+        isPhrase : Boolean type
+            When True the second term has to occur after the first one
+
+        Returns
+        -------
+        isMatch : Boolean type
+            True if the two terms occur within the wanted distance, otherwise False
+        """
+        if linearMergeMatchCompiled is not None:
+            return linearMergeMatchCompiled(positions1, positions2, distance, isPhrase)
+        if len(positions1) * len(positions2) > self.proximityBroadcastLimit: # Avoid building huge matrices for very frequent terms
+            return linearMergeMatch(positions1, positions2, distance, isPhrase)
+        difference = positions1[:, None] - positions2[None, :]
+        if isPhrase:
+            mask = (difference <= 0) & (-difference <= distance) # Second term should appear only after the first one
+        else:
+            mask = np.abs(difference) <= distance
+        return bool(mask.any())
+
+    def executeTFIDFQueries(self, numberOfProcesses=1):
         """Initializes results variable and invokes necessary methods to execute each of the given tfidf ranked queries
 
+        Parameters
+        ----------
+        numberOfProcesses : Int type
+            The number of processes the queries are distributed to - e.g. os.cpu_count() to use every core
+
         Notes
         -----
         Does not return results. Instead, invokes the "writeTFIDFResultsToFile" method, which exports them to a file
         """
-        queryResults = OrderedDict()
-        for k, v in self.tfidfQueriesDictionary.items():
-            queryResults[k] = self.calculateTFIDF(v)
+        queryResults = self.executeQueries('calculateTFIDF', self.tfidfQueriesDictionary, numberOfProcesses)
         self.writeTFIDFResultsToFile(queryResults, 'out/results.ranked.txt')
 
     def calculateTFIDF(self, query):
@@ -194,24 +425,61 @@ class QueryProcessor(object):
         Returns
         -------
         queryDocumentScores : Dictionary type
-            Dictionary containing (key, value) pairs, where key = document ID and value = document score
+            Dictionary containing (key, value) pairs, where key = document ID and value = document score.
+            Holds only the "numberOfRankedResults" best documents, in descending score order with ties broken by ascending docID
         """
-        queryDocumentScores = {}
-        for term in self.ppr.tokenize(self.ppr.toLowerCase(query)):
-            termScore = 0
-            termStemmed = self.ppr.stemWordPorter(term)
-            if (len(term) > 0) and (self.ppr.isNotAStopword(term)):
-                termDictionary = self.ii.getTermDocumentDictionary(termStemmed)
-                termDictionarySize = len(termDictionary)
-                if (termDictionarySize == 0): # If the term does not exist in index just ignore it
-                    continue
-                for doc, positions in termDictionary.items():
-                    if doc not in queryDocumentScores:
-                        queryDocumentScores[doc] = (1.0 + np.log10(len(positions))) * (np.log10(float(self.collectionSize)/float(termDictionarySize))) # Initialize term score
-                    else:
-                        queryDocumentScores[doc] += (1.0 + np.log10(len(positions))) * (np.log10(float(self.collectionSize)/float(termDictionarySize))) # Add to term score
-
-        tfidfRanked = sorted(queryDocumentScores.items(), key=lambda (k,v): v, reverse = True)
+        scores = np.zeros(self.maxDocID + 1, dtype=np.float64) # Score accumulator indexed by document ID
+        matched = np.zeros(self.maxDocID + 1, dtype=bool) # Documents containing at least one query term
+        termCounts = Counter(self.ppr.extractTerms(query)) # Each distinct term is scored once - repeated query terms multiply its contribution
+        queryTerms = [] # (term, weight, largest possible contribution) of every query term found in the index
+        for termStemmed, termCount in termCounts.items():
+            if termStemmed in self.termIDFDictionary: # If the term does not exist in index just ignore it
+                termWeight = termCount * self.termIDFDictionary[termStemmed]
+                upperBound = termCount * self.termUpperBoundDictionary[termStemmed]
+                queryTerms.append((termStemmed, termWeight, upperBound))
+        queryTerms.sort(key=itemgetter(2), reverse=True) # MaxScore order - terms able to contribute the most are scored first
+        remainingUpperBounds = [] # Best score a document can still get from the terms after each one
+        remainingUpperBound = 0.0
+        for _, _, upperBound in reversed(queryTerms):
+            remainingUpperBounds.append(remainingUpperBound)
+            remainingUpperBound += upperBound
+        remainingUpperBounds.reverse()
+        scoredUpperBound = 0.0 # Best score a document can have from the terms scored so far - the k-th best score never exceeds it
+        candidates = None # Sorted docIDs still able to reach the top results - set once pruning starts
+        for (termStemmed, termWeight, upperBound), remainingUpperBound in zip(queryTerms, remainingUpperBounds):
+            docIDs = self.ii.getTermDocumentArrays(termStemmed)[0] # Only docIDs are needed - positions are never touched
+            contributions = self.termLogTFDictionary[termStemmed] * termWeight
+            if candidates is None:
+                scores[docIDs] += contributions # docIDs are unique within a term, so fancy indexing is safe
+                matched[docIDs] = True
+            elif len(candidates) < len(docIDs): # Only update the candidates - binary search them in the term's docIDs instead of reading the whole posting list
+                candidateIndices, termIndices = skewedIntersection(candidates, docIDs)
+                scores[candidates[candidateIndices]] += contributions[termIndices]
+            else: # Few postings - updating documents that are not candidates anymore does no harm
+                scores[docIDs] += contributions
+            scoredUpperBound += upperBound
+            if candidates is None and 0 < remainingUpperBound < scoredUpperBound: # Otherwise the threshold cannot exceed the remaining upper bound - skip computing it
+                matchedDocIDs = np.flatnonzero(matched)
+                if len(matchedDocIDs) >= self.numberOfRankedResults:
+                    kthIndex = len(matchedDocIDs) - self.numberOfRankedResults
+                    threshold = np.partition(scores[matchedDocIDs], kthIndex)[kthIndex] # k-th best score so far - computed once, a fixed lower bound of the final one
+                    if remainingUpperBound < threshold: # Documents not scored yet cannot reach the top results anymore
+                        candidates = matchedDocIDs
+            if candidates is not None: # Drop the candidates that cannot reach the threshold even with every remaining term
+                candidates = candidates[scores[candidates] + remainingUpperBound >= threshold]
+
+        if candidates is None:
+            candidates = np.flatnonzero(matched)
+        if len(candidates) > self.numberOfRankedResults: # Partial selection of the top results instead of sorting every scored document
+            candidateScores = scores[candidates]
+            kthIndex = len(candidates) - self.numberOfRankedResults
+            kthScore = np.partition(candidateScores, kthIndex)[kthIndex] # Score of the last document making the cutoff
+            isSelected = candidateScores > kthScore
+            tiedIndices = np.flatnonzero(candidateScores == kthScore) # Candidates are sorted, so the lowest docIDs win the remaining places
+            isSelected[tiedIndices[:self.numberOfRankedResults - np.count_nonzero(isSelected)]] = True
+            candidates = candidates[isSelected]
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))] # Descending score, ties in ascending docID order
+        queryDocumentScores = dict(zip(candidates.tolist(), scores[candidates].tolist()))
         return queryDocumentScores
 
     def importBooleanQuery(self, pathToFile):
@@ -247,11 +515,8 @@ class QueryProcessor(object):
         with open(pathToFile, 'w') as output:
             for k, v in results.items():
                 if len(v) == 0:
-                    output.write('{:<3}{:<3}{:<8}{:<3}{:<8}{:<3}\n'.format(k,0,'null',0,'null',0))
-                for counter, doc in enumerate(sorted(v)):
-                    if counter == 999:
-                        break
-                    output.write('{:<3}{:<3}{:<8}{:<3}{:<8}{:<3}\n'.format(k,0,doc,0,1,0))
+                    output.write(emptyResultRow(k))
+                output.writelines([booleanResultRow(k,0,doc,0,1,0) for doc in islice(v, 999)]) # Bitmaps iterate in ascending docID order
 
     def writeTFIDFResultsToFile(self, results, pathToFile):
         """Exports tfidf results to a file following a certain structure
@@ -259,7 +524,7 @@ class QueryProcessor(object):
         Parameters
         ----------
         results : Dictionary type
-            The dictionary with (key, value) pairs, where key = query ID and value = corresponding results
+            The dictionary with (key, value) pairs, where key = query ID and value = corresponding results in descending score order (see "calculateTFIDF")
         pathToFile : String type
             The path leading to the output file
         """
@@ -269,11 +534,8 @@ class QueryProcessor(object):
         with open(pathToFile, 'w') as output:
             for k, v in results.items():
                 if len(v) == 0:
-                    output.write('{:<3}{:<3}{:<8}{:<3}{:<8}{:<3}\n'.format(k,0,'null',0,'null',0))
-                for counter, entry in enumerate(sorted(v.items(), key=lambda (k,v): v, reverse = True)):
-                    if counter == 999:
-                        break
-                    output.write('{:<3}{:<3}{:<8}{:<3}{:<8.3f}{:<3}\n'.format(k,0,entry[0],0,entry[1],0))
+                    output.write(emptyResultRow(k))
+                output.writelines([rankedResultRow(k,0,doc,0,score,0) for doc, score in islice(v.items(), 999)]) # Results are already in descending score order
 
     def parseQueriesFile(self, pathToFile):
         """Parses a query file
@@ -283,7 +545,7 @@ class QueryProcessor(object):
         pathToFile : String type
             The query file location
         """
-        dictionaryOfQueries = OrderedDict() # Temp structure to keep queries
+        dictionaryOfQueries = {} # Temp structure to keep queries
         with open(pathToFile, 'r') as queryFile:
             for queryID, line in enumerate(queryFile):
                 splittedQuery = line.split(" ", 1)
@@ -308,21 +570,20 @@ class QueryProcessor(object):
     def expandQuery(self, numberOfTopDocuments, numberOfExpandedTerms):
         self.importResultsFromFile('out/results.ranked.txt', numberOfTopDocuments) # Import first 10 ranked results for each query
 
-        for queryID, relevantDocumentList in self.queryTopRelevantDocumentsDictionary.iteritems():
+        for queryID, relevantDocumentList in self.queryTopRelevantDocumentsDictionary.items():
             self.importDocsFromCollection('data/trec.sample.xml', relevantDocumentList)
             tempIndex = self.miniIndex.getIndexDictionary()
-            for term, documentDictionary in tempIndex.iteritems():
+            for term, documentDictionary in tempIndex.items():
                 termFrequency = 0
                 termScore = 0
-                for document, postings in documentDictionary.iteritems():
+                for document, postings in documentDictionary.items():
                     termFrequency += len(postings)
-                termDocumentFrequeny = len(self.ii.getTermDocumentDictionary(term))
-                termTFIDF = termFrequency * np.log10(float(self.collectionSize)/float(termDocumentFrequeny)) # Simple tfidf
+                termTFIDF = termFrequency * self.termIDFDictionary[term] # Simple tfidf - reuses the precomputed idf instead of a scalar np.log10 per term
                 self.termTFIDFDictionary[term] = termTFIDF
-            result = collections.OrderedDict(sorted(self.termTFIDFDictionary.items()))
+            result = dict(sorted(self.termTFIDFDictionary.items()))
             expandedTermsString = ""
             tempIndex.clear()
-            for counter, (entry, value) in enumerate(sorted(result.items(), key=lambda (k,v): v, reverse = True)):
+            for counter, (entry, value) in enumerate(sorted(result.items(), key=itemgetter(1), reverse = True)):
                 expandedTermsString += entry + " "
                 if counter == numberOfExpandedTerms-1: # top 10 expanded terms
                     break
@@ -388,10 +649,9 @@ class QueryProcessor(object):
                         else:
                             headlineAndText = text
 
-                        for word in self.ppr.tokenize(self.ppr.toLowerCase(headlineAndText)):
-                            if (len(word) > 0) and (self.ppr.isNotAStopword(word)):
-                                self.miniIndex.insertTermOccurrence(self.ppr.stemWordPorter(word), 1, position)
-                                position += 1
+                        for term in self.ppr.extractTerms(headlineAndText):
+                            self.miniIndex.insertTermOccurrence(term, 1, position)
+                            position += 1
                     else:
                         continue
 
@@ -416,18 +676,96 @@ class QueryProcessor(object):
         ----------
         pathToFile : String type
             The index file location
+
+        Notes
+        -----
+        The parsed index is also stored in binary form next to the text file ("<pathToFile>.npz").
+        Subsequent imports load that file instead of parsing the text, as long as the size and modification time of the text file
+        are exactly those recorded in it - replacing the text file by any other one, even an older one, makes it parse the text again.
+        An unreadable binary file is ignored and the text is parsed again; failing to write it only prints a message
         """
+        packedPathToFile = pathToFile + '.npz'
+        textFileStatus = os.stat(pathToFile) # Taken before parsing, so a text file changed meanwhile never matches the stored stamp
+        sourceFileStamp = np.array([textFileStatus.st_size, textFileStatus.st_mtime_ns], dtype=np.int64)
+        isPackedIndexLoaded = False
+        if os.path.exists(packedPathToFile):
+            try:
+                isPackedIndexLoaded = self.ii.importPackedIndex(packedPathToFile, sourceFileStamp)
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as error: # Corrupt or foreign archive - fall back to the text file
+                print('Ignoring packed index {}: {}'.format(packedPathToFile, error))
+        if not isPackedIndexLoaded:
+            postingArrays = self.parseInvertedIndexFile(pathToFile)
+            self.ii.importPostingArrays(*postingArrays)
+            try:
+                self.ii.writePackedIndex(packedPathToFile, *postingArrays, sourceFileStamp=sourceFileStamp)
+            except OSError as error: # E.g. read-only directory - the cache is only an optimisation
+                print('Could not write packed index {}: {}'.format(packedPathToFile, error))
+        allDocIDs = np.concatenate([np.zeros(0, dtype=np.int32)] + [docIDs for docIDs, _ in self.ii.termDocumentArrays.values()])
+        self.docIDSet = FrozenBitMap(np.unique(allDocIDs).tolist()) # All docIDs - used for NOT operation. Construction picks run containers, as docIDs are mostly consecutive
+        self.collectionSize = len(self.docIDSet) # Updating collection size
+        if self.collectionSize > 0:
+            self.maxDocID = self.docIDSet.max()
+        self.precomputeTermWeights()
+
+    def parseInvertedIndexFile(self, pathToFile):
+        """Parses an inverted index text file straight into flat posting arrays (layout of "InvertedIndex.exportPackedIndex")
+
+        Parameters
+        ----------
+        pathToFile : String type
+            The index file location
+
+        Returns
+        -------
+        postingArrays : Tuple type
+            The terms, the offsets of each term's documents, the docIDs, the offsets of each document's positions and the positions
+        """
+        terms = []
+        termOffsets = []
+        docIDStrings = []
+        positionStrings = []
+        termFrequencies = []
+        term = None
         with open(pathToFile, 'r') as invertedIndexFile:
             for line in invertedIndexFile:
                 if(line[0]) != '\t':
                     term = line.split(':')[0] # extract term
                 else:
+                    if term is not None: # First document of the term
+                        terms.append(term)
+                        termOffsets.append(len(docIDStrings))
+                        term = None
                     termDocEntry = line.split(':')
-                    docID = int(termDocEntry[0].strip())
-                    self.docIDSet.add(docID) # Adding docID to set - used for NOT operation
-                    listOfPositions = map(int, termDocEntry[1].strip().split(','))
-                    self.ii.insertMultipleTermOccurrences(term, docID, listOfPositions) # Put correct position through string index
-        self.collectionSize = len(self.docIDSet) # Updating collection size
+                    docIDStrings.append(termDocEntry[0])
+                    positionStrings.append(termDocEntry[1])
+                    termFrequencies.append(termDocEntry[1].count(',') + 1)
+        termOffsets.append(len(docIDStrings))
+        docIDs = np.fromstring(','.join(docIDStrings), sep=',', dtype=np.int32) # A single numpy parse for all docIDs and one for all positions
+        positions = np.fromstring(','.join(positionStrings), sep=',', dtype=np.int32)
+        positionOffsets = np.zeros(len(termFrequencies) + 1, dtype=np.int64)
+        positionOffsets[1:] = np.cumsum(termFrequencies)
+        if len(docIDs) != len(docIDStrings) or len(positions) != positionOffsets[-1]:
+            raise ValueError('Malformed inverted index file: {}'.format(pathToFile))
+        return (terms, np.array(termOffsets, dtype=np.int64), docIDs, positionOffsets, positions)
+
+    def precomputeTermWeights(self):
+        """Precomputes the query independent parts of the TFIDF score - the idf of every term and the tf weights of its postings
+
+        Notes
+        -----
+        Depends on the collection size, so it is invoked after the inverted index has been imported
+        """
+        terms = list(self.ii.termDocumentArrays.keys())
+        listOfTermFrequencies = [termFrequencies for _, termFrequencies in self.ii.termDocumentArrays.values()]
+        termOffsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        termOffsets[1:] = np.cumsum([len(termFrequencies) for termFrequencies in listOfTermFrequencies])
+        logTermFrequencies = 1.0 + np.log10(np.concatenate([np.zeros(0, dtype=np.int32)] + listOfTermFrequencies)) # Computed over all postings at once, then sliced per term
+        idfs = np.log10(float(self.collectionSize) / np.diff(termOffsets))
+        upperBounds = np.maximum.reduceat(logTermFrequencies, termOffsets[:-1]) * idfs if len(terms) > 0 else idfs
+        listOfTermOffsets = termOffsets.tolist()
+        self.termIDFDictionary = dict(zip(terms, idfs.tolist()))
+        self.termLogTFDictionary = {term: logTermFrequencies[listOfTermOffsets[i]:listOfTermOffsets[i + 1]] for i, term in enumerate(terms)}
+        self.termUpperBoundDictionary = dict(zip(terms, upperBounds.tolist()))
 
     def exportInvertedIndexToDirectory(self, pathToFile):
         """Invokes the inverted index export method in case the current inverted index has to be stored
@@ -0,0 +1,101 @@
+from collections.abc import Mapping
+import numpy as np
+
+class TermPostings(Mapping):
+    """Class implementing the compact, read-only posting list of a term.
+    Stores the postings in three contiguous arrays (CSR layout) instead of a dictionary with one position list per document,
+    while still behaving like a {docID: positions} dictionary
+
+    Fields
+    ------
+    docIDs : Numpy array type of int32
+        The sorted IDs of the documents containing the term
+    offsets : Numpy array type of int64
+        The positions of document i are positions[offsets[i]:offsets[i+1]]
+    positions : Numpy array type of int32
+        The array holding the positions of the term in all its documents, in docID order - may be shared with the postings of other terms
+    """
+
+    def __init__(self, docIDs, offsets, positions):
+        """Constructor of TermPostings object - the arrays are used as given, without copying or sorting
+
+        Parameters
+        ----------
+        docIDs : Numpy array type of int32
+            The sorted IDs of the documents containing the term
+        offsets : Numpy array type of int64
+            The offsets of each document's positions within "positions" - one more entry than "docIDs"
+        positions : Numpy array type of int32
+            The array holding the positions of the term, e.g. a slice of a whole packed index
+        """
+        self.docIDs = docIDs
+        self.offsets = offsets
+        self.positions = positions
+
+    @classmethod
+    def fromDictionary(cls, documentDictionary):
+        """Builds the compact posting list of a term from its {docID: positions} dictionary
+
+        Parameters
+        ----------
+        documentDictionary : Dictionary type
+            Dictionary containing (key, value) pairs, where key = document ID and value = list or array of positions
+
+        Returns
+        -------
+        termPostings : TermPostings type
+            The compact posting list, sorted by document ID
+        """
+        sortedDocIDs = sorted(documentDictionary)
+        docIDs = np.array(sortedDocIDs, dtype=np.int32)
+        offsets = np.zeros(len(sortedDocIDs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(documentDictionary[docID]) for docID in sortedDocIDs])
+        positions = np.concatenate([np.zeros(0, dtype=np.int32)] + [np.asarray(documentDictionary[docID], dtype=np.int32) for docID in sortedDocIDs])
+        return cls(docIDs, offsets, positions)
+
+    def getPositionsAt(self, index):
+        """Returns the positions of the term in the document stored at the given index - no docID lookup needed
+
+        Parameters
+        ----------
+        index : Int type
+            The index of the document within "docIDs"
+
+        Returns
+        -------
+        positions : Numpy array type of int32
+            A view of the positions of the term in that document
+        """
+        return self.positions[self.offsets[index]:self.offsets[index + 1]]
+
+    def getAllPositions(self):
+        """Returns the positions of the term in all its documents
+
+        Returns
+        -------
+        positions : Numpy array type of int32
+            A view of the positions of every document, concatenated in docID order
+        """
+        return self.positions[self.offsets[0]:self.offsets[-1]]
+
+    def getTermFrequencies(self):
+        """Returns the number of occurrences of the term in each of its documents
+
+        Returns
+        -------
+        termFrequencies : Numpy array type of int32
+            The term frequencies, aligned with "docIDs"
+        """
+        return np.diff(self.offsets).astype(np.int32)
+
+    def __getitem__(self, docID):
+        index = np.searchsorted(self.docIDs, docID)
+        if index == len(self.docIDs) or self.docIDs[index] != docID:
+            raise KeyError(docID)
+        return self.getPositionsAt(index)
+
+    def __iter__(self):
+        return iter(self.docIDs.tolist())
+
+    def __len__(self):
+        return len(self.docIDs)